@@ -1,9 +1,10 @@
 # This is a simplified Aerie for prototyping purposes
 from collections import namedtuple
-import inspect
+import heapq
+import itertools
 
-from protocol import Completed, Delay, AwaitCondition, Call, Directive, make_generator
-from event_graph import EventGraph
+from protocol import Completed, Delay, AwaitCondition, Call, Directive, make_generator, make_activity_dispatch
+from event_graph import EventGraph, EMPTY
 
 Event = namedtuple("Event", "topic value")
 
@@ -14,7 +15,7 @@ class SimulationEngine:
         self.current_task_frame = TaskFrame(self.elapsed_time)
         self.schedule = JobSchedule()
         self.model = None  # Filled in by register_model
-        self.activity_types_by_name = None  # Filled in by register_model
+        self.activity_dispatch = None  # Filled in by register_activity_types
         self.task_start_times = {}
         self.task_directives = {}
         self.task_inputs = {}
@@ -24,11 +25,13 @@ class SimulationEngine:
 
     def register_model(self, cls):
         self.model = cls()
-        self.activity_types_by_name = self.model.get_activity_types()
         return self.model
 
+    def register_activity_types(self):
+        self.activity_dispatch = make_activity_dispatch(self.model.get_activity_types())
+
     def spawn(self, directive_type, arguments):
-        task = make_task(self.model, directive_type, arguments)
+        task = make_task(self.model, self.activity_dispatch, directive_type, arguments)
         self.task_inputs[task] = (directive_type, arguments)
         self.task_directives[task] = Directive(directive_type, self.elapsed_time, arguments)
         self.spawn_task(task)
@@ -47,7 +50,7 @@ class SimulationEngine:
         self.current_task_frame = parent_task_frame
 
     def defer(self, directive_type, duration, arguments):
-        task = make_task(self.model, directive_type, arguments)
+        task = make_task(self.model, self.activity_dispatch, directive_type, arguments)
         self.schedule.schedule(self.elapsed_time + duration, task)
         self.task_start_times[task] = self.elapsed_time + duration
         self.task_inputs[task] = (directive_type, arguments)
@@ -78,7 +81,7 @@ class SimulationEngine:
                 self.schedule.schedule(self.elapsed_time, self.awaiting_tasks[task])
                 del self.awaiting_tasks[task]
         elif type(task_status) == Call:
-            child_task = make_task(self.model, task_status.child_task, task_status.args)
+            child_task = make_task(self.model, self.activity_dispatch, task_status.child_task, task_status.args)
             self.awaiting_tasks[child_task] = task
             self.task_inputs[child_task] = (task_status.child_task, task_status.args)
             self.task_directives[child_task] = Directive(task_status.child_task, self.elapsed_time, task_status.args)
@@ -105,9 +108,9 @@ class TaskFrame:
     def read(self, topic_or_topics, function):
         topics = [topic_or_topics] if type(topic_or_topics) != list else topic_or_topics
         res = []
-        for start_offset, x in self.get_visible_history():
+        for start_offset, x in self.iter_visible_history():
             filtered = EventGraph.filter(x, topics)
-            if type(filtered) != EventGraph.Empty:
+            if filtered is not EMPTY:
                 res.append((start_offset, filtered))
         return function(res)
 
@@ -116,25 +119,36 @@ class TaskFrame:
         self.tip = EventGraph.empty()
 
     def get_visible_history(self):
+        return self.history + [self._get_current_history_entry()]
+
+    def iter_visible_history(self):
+        """
+        Like get_visible_history, but without copying the history
+        """
+        yield from self.history
+        yield self._get_current_history_entry()
+
+    def _get_current_history_entry(self):
+        if not self.branches:
+            return self.elapsed_time, self.tip
         res = EventGraph.empty()
         for base, _ in self.branches:
             res = EventGraph.sequentially(res, base)
         res = EventGraph.sequentially(res, self.tip)
-        return self.history + [(self.elapsed_time, res)]
+        return self.elapsed_time, res
 
     def collect(self):
+        if not self.branches:
+            return self.tip
         res = self.tip
         for base, event_graph in reversed(self.branches):
             res = EventGraph.sequentially(base, EventGraph.concurrently(event_graph, res))
         return res
 
 
-def make_task(model, directive_type, arguments):
-    try:
-        func = model.get_activity_types()[directive_type]
-    except:
-        print()
-    if inspect.isgeneratorfunction(func):
+def make_task(model, activity_dispatch, directive_type, arguments):
+    is_generator_function, func = activity_dispatch[directive_type]
+    if is_generator_function:
         return func.__call__(model, **arguments)
     else:
         return make_generator(func, dict(**arguments, model=model))
@@ -142,35 +156,39 @@ def make_task(model, directive_type, arguments):
 
 class JobSchedule:
     def __init__(self):
-        self._schedule = {}
+        self._heap = []  # heap of tuples (start_offset, insertion order, task)
+        self._counter = itertools.count()
+        self._scheduled = set()  # tasks currently in the heap, for duplicate detection
 
     def schedule(self, start_offset, task):
         if type(start_offset) is not int:
             raise ValueError("start_offset must be an int. Received: " + start_offset)
-        if not start_offset in self._schedule:
-            self._schedule[start_offset] = []
-        for _, batch in self._schedule.items():
-            if task in batch:
-                raise Exception("Double scheduling task: " + str(task))
-        self._schedule[start_offset].append(task)
+        if task in self._scheduled:
+            raise Exception("Double scheduling task: " + str(task))
+        self._scheduled.add(task)
+        heapq.heappush(self._heap, (start_offset, next(self._counter), task))
 
     def peek_next_time(self):
-        return min(self._schedule)
+        return self._heap[0][0]
 
     def get_next_batch(self):
         next_time = self.peek_next_time()
-        res = self._schedule[next_time]
-        del self._schedule[next_time]
+        res = []
+        while self._heap and self._heap[0][0] == next_time:
+            _, _, task = heapq.heappop(self._heap)
+            self._scheduled.remove(task)
+            res.append(task)
         return res
 
     def is_empty(self):
-        return len(self._schedule) == 0
+        return not self._heap
 
 
 def simulate(register_engine, model_class, plan):
     engine = SimulationEngine()
     engine.register_model(model_class)
     register_engine(engine)
+    engine.register_activity_types()
 
     for directive in plan.directives:
         engine.defer(directive.type, directive.start_time, directive.args)
@@ -185,7 +203,7 @@ def simulate(register_engine, model_class, plan):
             task_status, event_graph = engine.step(task)
             batch_event_graph = EventGraph.concurrently(batch_event_graph, event_graph)
         engine.current_task_frame = TaskFrame(engine.elapsed_time, history=engine.events)
-        if type(batch_event_graph) != EventGraph.Empty:
+        if batch_event_graph is not EMPTY:
             if engine.events and engine.events[-1][0] == engine.elapsed_time:
                 engine.events[-1] = (engine.elapsed_time, EventGraph.sequentially(engine.events[-1][1], batch_event_graph))
             else:
@@ -1,16 +1,43 @@
 import builtins
 from collections import namedtuple
 
+# Every node has a KIND, so that traversals can dispatch on a single attribute load instead of repeated type() checks
+EMPTY_KIND = 0
+ATOM_KIND = 1
+SEQUENTIALLY_KIND = 2
+CONCURRENTLY_KIND = 3
+
+
+_NO_TOPICS = frozenset()
+
 
 class EventGraph:
-    Empty = namedtuple("Empty", "")
-    Atom = namedtuple("Atom", "value")
-    Sequentially = namedtuple("Sequentially", "prefix suffix")
-    Concurrently = namedtuple("Concurrently", "left right")
+    class Empty(namedtuple("Empty", "")):
+        __slots__ = ()
+        KIND = EMPTY_KIND
+        _instance = None
+
+        def __new__(cls):
+            # Copies and unpickled instances go through __new__ too, so they all come back as EMPTY
+            if cls._instance is None:
+                cls._instance = super().__new__(cls)
+            return cls._instance
+
+    class Atom(namedtuple("Atom", "value")):
+        __slots__ = ()
+        KIND = ATOM_KIND
+
+    class Sequentially(namedtuple("Sequentially", "prefix suffix")):
+        __slots__ = ()
+        KIND = SEQUENTIALLY_KIND
+
+    class Concurrently(namedtuple("Concurrently", "left right")):
+        __slots__ = ()
+        KIND = CONCURRENTLY_KIND
 
     @staticmethod
     def empty():
-        return EventGraph.Empty()
+        return EMPTY
 
     @staticmethod
     def atom(value):
@@ -18,17 +45,17 @@ class EventGraph:
 
     @staticmethod
     def sequentially(prefix, suffix):
-        if type(prefix) == EventGraph.Empty:
+        if prefix is EMPTY:
             return suffix
-        elif type(suffix) == EventGraph.Empty:
+        elif suffix is EMPTY:
             return prefix
         return EventGraph.Sequentially(prefix, suffix)
 
     @staticmethod
     def concurrently(left, right):
-        if type(left) == EventGraph.Empty:
+        if left is EMPTY:
             return right
-        elif type(right) == EventGraph.Empty:
+        elif right is EMPTY:
             return left
         return EventGraph.Concurrently(left, right)
 
@@ -64,79 +91,214 @@ class EventGraph:
     def iter(event_graph):
         rest = event_graph
         while True:
-            if type(rest) is EventGraph.Empty:
+            kind = rest.KIND
+            if kind == EMPTY_KIND:
                 return
-            elif type(rest) is EventGraph.Atom:
+            elif kind == ATOM_KIND:
                 yield rest.value
                 return
-            elif type(rest) is EventGraph.Sequentially:
-                if type(rest.prefix) is EventGraph.Sequentially:
+            elif kind == SEQUENTIALLY_KIND:
+                if rest.prefix.KIND == SEQUENTIALLY_KIND:
                     rest = EventGraph.sequentially(
                         rest.prefix.prefix, EventGraph.sequentially(rest.prefix.suffix, rest.suffix)
                     )
                     continue
-                elif type(rest.prefix) is EventGraph.Atom:
+                elif rest.prefix.KIND == ATOM_KIND:
                     yield rest.prefix.value
                     rest = rest.suffix
                     continue
-            elif type(rest) is EventGraph.Concurrently:
+            elif kind == CONCURRENTLY_KIND:
                 raise ValueError("Cannot iterate across a concurrent node: " + EventGraph.to_string(rest))
             else:
                 raise ValueError("Wat. " + str(rest))
 
+    # filter, filter_p, and to_set accept an optional _memo dict, mapping id(node) to (node, result).
+    # Subgraphs are frequently shared, so passing the same memo across several calls with the same topics/predicate
+    # visits each shared subgraph only once. The node is kept in the memo so that its id cannot be reused while the
+    # memo is alive.
     @staticmethod
-    def filter(event_graph, topics):
-        if type(event_graph) == EventGraph.Empty:
+    def filter(event_graph, topics, _memo=None, _topics_memo=None):
+        """
+        A _topics_memo, as filled in by EventGraph.topics, lets filter skip subgraphs that contain none (or only) of
+        the given topics. It only pays off when it is shared across calls on the same graphs.
+        """
+        if _memo is None:
+            _memo = {}
+        kind = event_graph.KIND
+        if kind == EMPTY_KIND:
             return event_graph
-        if type(event_graph) == EventGraph.Atom:
+        if kind == ATOM_KIND:
             if event_graph.value.topic in topics:
-                return EventGraph.atom(event_graph.value)
+                return event_graph
             else:
-                return EventGraph.empty()
-        if type(event_graph) == EventGraph.Sequentially:
-            return EventGraph.sequentially(EventGraph.filter(event_graph.prefix, topics), EventGraph.filter(event_graph.suffix, topics))
-        if type(event_graph) == EventGraph.Concurrently:
-            return EventGraph.concurrently(EventGraph.filter(event_graph.left, topics), EventGraph.filter(event_graph.right, topics))
-        raise ValueError("Not an event_graph: " + str(event_graph))
+                return EMPTY
+        if kind != SEQUENTIALLY_KIND and kind != CONCURRENTLY_KIND:
+            raise ValueError("Not an event_graph: " + str(event_graph))
+        if _topics_memo is not None:
+            entry = _topics_memo.get(id(event_graph))
+            node_topics = entry[1] if entry is not None else EventGraph.topics(event_graph, _topics_memo)
+            if node_topics.isdisjoint(topics):
+                return EMPTY
+            if node_topics.issubset(topics):
+                return event_graph
+        if id(event_graph) in _memo:
+            return _memo[id(event_graph)][1]
+        first = EventGraph.filter(event_graph[0], topics, _memo, _topics_memo)
+        second = EventGraph.filter(event_graph[1], topics, _memo, _topics_memo)
+        if first is event_graph[0] and second is event_graph[1]:
+            res = event_graph
+        elif kind == SEQUENTIALLY_KIND:
+            res = EventGraph.sequentially(first, second)
+        else:
+            res = EventGraph.concurrently(first, second)
+        _memo[id(event_graph)] = (event_graph, res)
+        return res
 
     @staticmethod
-    def filter_p(event_graph, predicate):
-        if type(event_graph) == EventGraph.Empty:
-            return event_graph
-        if type(event_graph) == EventGraph.Atom:
-            if predicate(event_graph.value):
-                return EventGraph.atom(event_graph.value)
+    def topics(event_graph, _memo):
+        """
+        Returns the frozenset of topics in event_graph. Topics are computed on demand and kept in _memo, a side table
+        mapping id(node) to (node, topics), so nodes themselves stay plain tuples. A node's set reuses one of its
+        children's sets when that child already contains the other.
+        """
+        results = []  # topics of children, in post-order
+        worklist = [(False, event_graph)]  # (children_done, node)
+        while worklist:
+            children_done, node = worklist.pop()
+            if not children_done and id(node) in _memo:
+                results.append(_memo[id(node)][1])
+                continue
+            # minimally_replaying_engine puts descriptive strings in its event graphs. They contain no topics.
+            kind = getattr(node, "KIND", EMPTY_KIND)
+            if kind == EMPTY_KIND:
+                results.append(_NO_TOPICS)
+                continue
+            if kind == ATOM_KIND:
+                res = frozenset((node.value.topic,))
             else:
-                return EventGraph.empty()
-        if type(event_graph) == EventGraph.Sequentially:
-            return EventGraph.sequentially(EventGraph.filter_p(event_graph.prefix, predicate), EventGraph.filter_p(event_graph.suffix, predicate))
-        if type(event_graph) == EventGraph.Concurrently:
-            return EventGraph.concurrently(EventGraph.filter_p(event_graph.left, predicate), EventGraph.filter_p(event_graph.right, predicate))
-        raise ValueError("Not an event_graph: " + str(event_graph))
+                if not children_done:
+                    worklist.append((True, node))
+                    worklist.append((False, node[1]))
+                    worklist.append((False, node[0]))
+                    continue
+                second = results.pop()
+                first = results.pop()
+                if second <= first:
+                    res = first
+                elif first <= second:
+                    res = second
+                else:
+                    res = first | second
+            _memo[id(node)] = (node, res)
+            results.append(res)
+        return results.pop()
+
+    @staticmethod
+    def filter_p(event_graph, predicate, _memo=None):
+        """
+        Walks event_graph iteratively, in post-order. A node whose children are all kept unchanged is returned as-is
+        rather than rebuilt, so filters that drop few events allocate few new nodes.
+        """
+        if _memo is None:
+            _memo = {}
+        results = []  # filtered children, in post-order
+        worklist = [(False, event_graph)]  # (children_done, node)
+        while worklist:
+            children_done, node = worklist.pop()
+            kind = node.KIND
+            if kind == EMPTY_KIND:
+                results.append(node)
+                continue
+            if not children_done and id(node) in _memo:
+                results.append(_memo[id(node)][1])
+                continue
+            if kind == ATOM_KIND:
+                res = node if predicate(node.value) else EMPTY
+            elif kind == SEQUENTIALLY_KIND or kind == CONCURRENTLY_KIND:
+                if not children_done:
+                    worklist.append((True, node))
+                    worklist.append((False, node[1]))
+                    worklist.append((False, node[0]))
+                    continue
+                second = results.pop()
+                first = results.pop()
+                if first is node[0] and second is node[1]:
+                    res = node
+                elif kind == SEQUENTIALLY_KIND:
+                    res = EventGraph.sequentially(first, second)
+                else:
+                    res = EventGraph.concurrently(first, second)
+            else:
+                raise ValueError("Not an event_graph: " + str(node))
+            _memo[id(node)] = (node, res)
+            results.append(res)
+        return results.pop()
 
     @staticmethod
     def map(event_graph, f):
-        if type(event_graph) == EventGraph.Empty:
+        kind = event_graph.KIND
+        if kind == EMPTY_KIND:
             return event_graph
-        if type(event_graph) == EventGraph.Atom:
+        if kind == ATOM_KIND:
             return EventGraph.atom(f(event_graph.value))
-        if type(event_graph) == EventGraph.Sequentially:
+        if kind == SEQUENTIALLY_KIND:
             return EventGraph.sequentially(EventGraph.map(event_graph.prefix, f), EventGraph.map(event_graph.suffix, f))
-        if type(event_graph) == EventGraph.Concurrently:
+        if kind == CONCURRENTLY_KIND:
             return EventGraph.concurrently(EventGraph.map(event_graph.left, f), EventGraph.map(event_graph.right, f))
         raise ValueError("Not an event_graph: " + str(event_graph))
 
     @staticmethod
-    def to_set(event_graph, f=lambda x: x):
-        if type(event_graph) == EventGraph.Empty:
-            return set()
-        if type(event_graph) == EventGraph.Atom:
-            return {f(event_graph.value)}
-        if type(event_graph) == EventGraph.Sequentially:
-            return EventGraph.to_set(event_graph.prefix, f).union(EventGraph.to_set(event_graph.suffix, f))
-        if type(event_graph) == EventGraph.Concurrently:
-            return EventGraph.to_set(event_graph.left, f).union(EventGraph.to_set(event_graph.right, f))
-        raise ValueError("Not an event_graph: " + str(event_graph))
+    def to_set(event_graph, f=lambda x: x, _memo=None):
+        if _memo is not None:
+            return set(EventGraph._to_set_helper(event_graph, f, _memo))
+        return EventGraph.filter_to_set(event_graph, None, f)
+
+    @staticmethod
+    def filter_to_set(event_graph, predicate, f=lambda x: x):
+        """
+        Equivalent to to_set(filter_p(event_graph, predicate), f), but builds no filtered graph. A predicate of None
+        keeps every event.
+        """
+        # Walk the graph iteratively into a single set, rather than building a set per node. Shared subgraphs are only
+        # visited once.
+        res = set()
+        visited = set()
+        worklist = [event_graph]
+        while worklist:
+            node = worklist.pop()
+            kind = node.KIND
+            if kind == ATOM_KIND:
+                if predicate is None or predicate(node.value):
+                    res.add(f(node.value))
+            elif kind == SEQUENTIALLY_KIND or kind == CONCURRENTLY_KIND:
+                if id(node) not in visited:
+                    visited.add(id(node))
+                    worklist.append(node[1])
+                    worklist.append(node[0])
+            elif kind != EMPTY_KIND:
+                raise ValueError("Not an event_graph: " + str(node))
+        return res
+
+    @staticmethod
+    def _to_set_helper(event_graph, f, memo):
+        """
+        Returns a frozenset, so that memoized results can be shared safely
+        """
+        if id(event_graph) in memo:
+            return memo[id(event_graph)][1]
+        kind = event_graph.KIND
+        if kind == EMPTY_KIND:
+            return frozenset()
+        if kind == ATOM_KIND:
+            res = frozenset((f(event_graph.value),))
+        elif kind == SEQUENTIALLY_KIND:
+            res = EventGraph._to_set_helper(event_graph.prefix, f, memo).union(EventGraph._to_set_helper(event_graph.suffix, f, memo))
+        elif kind == CONCURRENTLY_KIND:
+            res = EventGraph._to_set_helper(event_graph.left, f, memo).union(EventGraph._to_set_helper(event_graph.right, f, memo))
+        else:
+            raise ValueError("Not an event_graph: " + str(event_graph))
+        memo[id(event_graph)] = (event_graph, res)
+        return res
 
     @staticmethod
     def is_event_graph(event_graph):
@@ -152,16 +314,14 @@ class EventGraph:
 
     @staticmethod
     def is_empty(event_graph):
-        if type(event_graph) == EventGraph.Empty:
-            return True
-        if type(event_graph) == EventGraph.Atom:
-            return False
-        if type(event_graph) == EventGraph.Sequentially:
-            return False
-        if type(event_graph) == EventGraph.Concurrently:
-            return False
-        raise ValueError("Not an event_graph: " + str(event_graph))
+        kind = getattr(event_graph, "KIND", None)
+        if kind is None:
+            raise ValueError("Not an event_graph: " + str(event_graph))
+        return kind == EMPTY_KIND
+
 
+# The only instance of EventGraph.Empty. Smart constructors and traversals compare against it by identity
+EMPTY = EventGraph.Empty()
 
 EventGraph.Empty.__repr__ = EventGraph.to_string
 EventGraph.Atom.__repr__ = EventGraph.to_string
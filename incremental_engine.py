@@ -1,8 +1,9 @@
 """
 This implementation attempts to weave together older and newer event graphs.
 """
-from collections import namedtuple
-import inspect
+from collections import defaultdict, deque, namedtuple
+import heapq
+import itertools
 from typing import List, Tuple
 
 from plan_diff import diff
@@ -14,8 +15,9 @@ from protocol import (
     Call,
     Plan,
     hashable_directive,
+    make_activity_dispatch,
 )
-from event_graph import EventGraph
+from event_graph import EventGraph, EMPTY_KIND, ATOM_KIND, SEQUENTIALLY_KIND, CONCURRENTLY_KIND
 
 Event = namedtuple("Event", "topic value progeny")
 
@@ -28,58 +30,64 @@ make_finish_topic = lambda x: ("FINISH", x)
 
 class SimulationEngine:
     def __init__(self):
-        self.task_children_spawned = {}
-        self.task_children_called = {}
+        self.task_children_spawned = defaultdict(list)
+        self.task_children_called = defaultdict(list)
         self.elapsed_time = 0
         self.events: EventHistory = []  # list of tuples (start_offset, event_graph)
         self.current_task_frame = None  # created by step
         self.schedule = JobSchedule()
         self.model = None  # Filled in by register_model
-        self.activity_types_by_name = None  # Filled in by register_model
+        self.activity_dispatch = None  # Filled in by register_activity_types
         self.task_start_times = {}
         self.task_directives = {}
+        self.plan_directive_to_task = {}  # map from hashable_directive to task, maintained by set_task_directive
         self.task_inputs = {}
         self.awaiting_conditions = []  # tuple (condition, task)
         self.awaiting_tasks = {}  # map from blocking task to blocked task
         self.spans = []  # tuple (directive, start time, end time)
+        self.read_atoms = {}  # map from (task, topics) to a shared READ atom, see TaskFrame.read
+        self.topics_memo = {}  # map from id(node) to (node, topics), see EventGraph.topics
 
     def register_model(self, cls):
         self.model = cls()
-        self.activity_types_by_name = self.model.get_activity_types()
         return self.model
 
+    def register_activity_types(self):
+        self.activity_dispatch = make_activity_dispatch(self.model.get_activity_types())
+
     def spawn(self, directive_type, arguments):
-        task = make_task(self.model, directive_type, arguments)
+        task = make_task(self.model, self.activity_dispatch, directive_type, arguments)
         self.task_inputs[task] = (directive_type, arguments)
-        self.task_directives[task] = Directive(directive_type, self.elapsed_time, arguments)
+        self.set_task_directive(task, Directive(directive_type, self.elapsed_time, arguments))
         self.spawn_task(task)
 
     def spawn_task(self, task, is_call=False):
         self.current_task_frame.emit(SPECIAL_SPAWN_TOPIC, task)
         self.task_start_times[task] = self.elapsed_time
         parent_task_frame = self.current_task_frame
-        task_frame = TaskFrame(self.elapsed_time, parent_task_frame._get_visible_history(), task=task)
+        task_frame = TaskFrame(self.elapsed_time, parent_task_frame._get_visible_history(), task=task,
+                               read_atoms=self.read_atoms, topics_memo=self.topics_memo)
         task_status, events = self.step(task, task_frame)
         if parent_task_frame.task is not None:
             if is_call:
-                if parent_task_frame.task not in self.task_children_called:
-                    self.task_children_called[parent_task_frame.task] = []
                 self.task_children_called[parent_task_frame.task].append(task)
             else:
-                if parent_task_frame.task not in self.task_children_spawned:
-                    self.task_children_spawned[parent_task_frame.task] = []
                 self.task_children_spawned[parent_task_frame.task].append(task)
         parent_task_frame.spawn(events)
         self.current_task_frame = parent_task_frame
 
     def defer(self, directive_type, duration, arguments):
-        task = make_task(self.model, directive_type, arguments)
+        task = make_task(self.model, self.activity_dispatch, directive_type, arguments)
         self.schedule.schedule(self.elapsed_time + duration, task)
         self.task_start_times[task] = self.elapsed_time + duration
         self.task_inputs[task] = (directive_type, arguments)
-        self.task_directives[task] = Directive(directive_type, self.elapsed_time + duration, arguments)
+        self.set_task_directive(task, Directive(directive_type, self.elapsed_time + duration, arguments))
         return task
 
+    def set_task_directive(self, task, directive):
+        self.task_directives[task] = directive
+        self.plan_directive_to_task[hashable_directive(directive)] = task
+
     def step(self, task, task_frame):
         restore = self.current_task_frame
         self.current_task_frame = task_frame
@@ -104,10 +112,10 @@ class SimulationEngine:
                 self.schedule.schedule(self.elapsed_time, self.awaiting_tasks[task])
                 del self.awaiting_tasks[task]
         elif type(task_status) == Call:
-            child_task = make_task(self.model, task_status.child_task, task_status.args)
+            child_task = make_task(self.model, self.activity_dispatch, task_status.child_task, task_status.args)
             self.awaiting_tasks[child_task] = task
             self.task_inputs[child_task] = (task_status.child_task, task_status.args)
-            self.task_directives[child_task] = Directive(task_status.child_task, self.elapsed_time, task_status.args)
+            self.set_task_directive(child_task, Directive(task_status.child_task, self.elapsed_time, task_status.args))
             self.spawn_task(child_task, is_call=True)
         else:
             raise ValueError("Unhandled task status: " + str(task_status))
@@ -118,12 +126,18 @@ class SimulationEngine:
 class TaskFrame:
     Branch = namedtuple("Branch", "base event_graph")
 
-    def __init__(self, elapsed_time, history, task=None):
+    def __init__(self, elapsed_time, history, task=None, read_atoms=None, topics_memo=None):
         self.elapsed_time = elapsed_time
         self.task = task
         self.tip = EventGraph.empty()
         self.history = history
         self.branches = []
+        if read_atoms is None:
+            read_atoms = {}
+        self.read_atoms = read_atoms
+        if topics_memo is None:
+            topics_memo = {}
+        self.topics_memo = topics_memo
 
     def emit(self, topic, value):
         if self.task is None:
@@ -135,11 +149,16 @@ class TaskFrame:
         Returns the visible event history, filtered to the given topic
         """
         topics = (topic_or_topics,) if type(topic_or_topics) != list else tuple(topic_or_topics)
-        # Track reads as Events
-        self.tip = EventGraph.sequentially(self.tip, EventGraph.Atom(Event(SPECIAL_READ_TOPIC, topics, self.task)))
+        # Track reads as Events. Tasks awaiting a condition repeat the same read on every step, so READ atoms are
+        # shared between identical reads rather than allocated each time
+        key = (self.task, topics)
+        if key not in self.read_atoms:
+            self.read_atoms[key] = EventGraph.Atom(Event(SPECIAL_READ_TOPIC, topics, self.task))
+        self.tip = EventGraph.sequentially(self.tip, self.read_atoms[key])
         res = []
-        for start_offset, x in self._get_visible_history():
-            filtered = EventGraph.filter(x, topics)
+        for start_offset, x in self._iter_visible_history():
+            # History entries are revisited by every read, so their topics are worth keeping across reads
+            filtered = EventGraph.filter(x, topics, _topics_memo=self.topics_memo)
             if not EventGraph.is_empty(filtered):
                 res.append((start_offset, filtered))
         return function(res)
@@ -149,22 +168,36 @@ class TaskFrame:
         self.tip = EventGraph.empty()
 
     def _get_visible_history(self):
+        return self.history + [self._get_current_history_entry()]
+
+    def _iter_visible_history(self):
+        """
+        Like _get_visible_history, but without copying the history
+        """
+        yield from self.history
+        yield self._get_current_history_entry()
+
+    def _get_current_history_entry(self):
+        if not self.branches:
+            return self.elapsed_time, self.tip
         res = EventGraph.empty()
         for base, _ in self.branches:
             res = EventGraph.sequentially(res, base)
         res = EventGraph.sequentially(res, self.tip)
-        return self.history + [(self.elapsed_time, res)]
+        return self.elapsed_time, res
 
     def collect(self):
+        if not self.branches:
+            return self.tip
         res = self.tip
         for base, event_graph in reversed(self.branches):
             res = EventGraph.sequentially(base, EventGraph.concurrently(event_graph, res))
         return res
 
 
-def make_task(model, directive_type, arguments):
-    func = model.get_activity_types()[directive_type]
-    if inspect.isgeneratorfunction(func):
+def make_task(model, activity_dispatch, directive_type, arguments):
+    is_generator_function, func = activity_dispatch[directive_type]
+    if is_generator_function:
         return func.__call__(model, **arguments)
     else:
         return make_generator(func, dict(**arguments, model=model))
@@ -172,36 +205,49 @@ def make_task(model, directive_type, arguments):
 
 class JobSchedule:
     def __init__(self):
-        self._schedule = {}
+        self._heap = []  # heap of tuples (start_offset, insertion order, task)
+        self._counter = itertools.count()
+        self._scheduled = {}  # map from id(task) to insertion order, for duplicate detection. Excludes batches of reads
+        self._unscheduled = set()  # insertion orders of heap entries that have been unscheduled
         self.last_time = None
 
     def schedule(self, start_offset, task):
         if self.last_time is not None:
             assert start_offset >= self.last_time, f"{start_offset} >= {self.last_time}"
-        if start_offset not in self._schedule:
-            self._schedule[start_offset] = []
-        for _, batch in self._schedule.items():
-            if task in batch and not type(task) == list:
+        order = next(self._counter)
+        if not type(task) == list:
+            if id(task) in self._scheduled:
                 raise Exception("Double scheduling task: " + str(task))
-        self._schedule[start_offset].append(task)
+            self._scheduled[id(task)] = order
+        heapq.heappush(self._heap, (start_offset, order, task))
 
     def unschedule(self, task, allow_event_graph=False):
-        for _, batch in self._schedule.items():
-            if task in batch and (allow_event_graph or not EventGraph.is_event_graph(task)):
-                batch.remove(task)
+        """
+        Unscheduled entries stay in the heap until popped, so that the time at which they were scheduled still
+        yields a (possibly empty) batch
+        """
+        if id(task) in self._scheduled and (allow_event_graph or not EventGraph.is_event_graph(task)):
+            self._unscheduled.add(self._scheduled.pop(id(task)))
 
     def peek_next_time(self):
-        return min(self._schedule)
+        return self._heap[0][0]
 
     def get_next_batch(self):
         next_time = self.peek_next_time()
-        res = self._schedule[next_time]
-        del self._schedule[next_time]
+        res = []
+        while self._heap and self._heap[0][0] == next_time:
+            _, order, task = heapq.heappop(self._heap)
+            if order in self._unscheduled:
+                self._unscheduled.remove(order)
+                continue
+            if not type(task) == list:
+                del self._scheduled[id(task)]
+            res.append(task)
         self.last_time = next_time
         return res
 
     def is_empty(self):
-        return len(self._schedule) == 0
+        return not self._heap
 
 
 def simulate(
@@ -230,6 +276,7 @@ def simulate(
         old_task_parent_called = {}
 
     all_events_from_previous_sim = old_events  # this variable name is to differentiate from future_events_from_previous_sim, introduced further down
+    progeny_index = index_topics_by_progeny(all_events_from_previous_sim)
 
     """
     Prepare for simulation
@@ -240,13 +287,15 @@ def simulate(
     engine.register_model(model_class)  # creates a new instance of the model class
     register_engine(
         engine)  # this is a hook for the called to be able to hold a reference to the engine. Called here to give a chance to override activities for testing.
+    engine.register_activity_types()
     for directive in plan.directives:  # Add all plan directives to the schedule
         engine.defer(directive.type, directive.start_time, directive.args)
     reads_grouped_by_start_offset = []
+    memo = {}
     for start_offset, event_graph in all_events_from_previous_sim:
         if not reads_grouped_by_start_offset or start_offset != reads_grouped_by_start_offset[-1][0]:
             reads_grouped_by_start_offset.append((start_offset, []))
-        reads_grouped_by_start_offset[-1][1].append(EventGraph.filter(event_graph, [SPECIAL_READ_TOPIC]))
+        reads_grouped_by_start_offset[-1][1].append(EventGraph.filter(event_graph, [SPECIAL_READ_TOPIC], memo))
     for start_offset, event_graphs in reads_grouped_by_start_offset:  # Add READ events from the previous sim to the schedule, so we remember to check whether they're stale
         if engine.task_start_times and start_offset <= min(engine.task_start_times.values()):
             continue
@@ -256,7 +305,7 @@ def simulate(
     stale_topics = {}  # map of topic to time at which it became stale
     restarted_tasks_not_yet_grafted = set()  # to-do list of tasks that have been restarted, but not stepped yet. If they are newly spawned, they will need to be grafted
     new_task_to_events = {}  # tracks events emitted by restarted tasks.
-    future_events_from_previous_sim = list(
+    future_events_from_previous_sim = deque(
         old_events)  # tracks events from the previous simulation that have not yet been added to engine.events
     saved_caller_events = {}  # Track events emitted by callers when restarting their children
     while not engine.schedule.is_empty():
@@ -265,11 +314,13 @@ def simulate(
         if stop_time is not None and resume_time >= stop_time:
             break
         engine.elapsed_time = resume_time
+        discarded_tasks = set(restarted_tasks).union(deleted_tasks)
+        memo = {}
         while future_events_from_previous_sim and future_events_from_previous_sim[0][0] < resume_time:
-            next_commit = future_events_from_previous_sim.pop(0)
+            next_commit = future_events_from_previous_sim.popleft()
             engine.events.append((next_commit[0], EventGraph.filter_p(next_commit[1],
-                                                                      lambda evt: evt.progeny not in set(
-                                                                          restarted_tasks).union(deleted_tasks))))
+                                                                      lambda evt: evt.progeny not in discarded_tasks,
+                                                                      memo)))
         batch = engine.schedule.get_next_batch()
         batch_reads = [x for x in batch if type(x) == list]
         batch_tasks = [x for x in batch if not type(x) == list]
@@ -279,19 +330,20 @@ def simulate(
         tasks_to_restart = set()
         while tasks_to_restart != prev_tasks_to_restart:
             prev_tasks_to_restart = set(tasks_to_restart)
-            affected_topics = get_topics_affected_by_tasks(all_events_from_previous_sim,
+            affected_topics = get_topics_affected_by_tasks(progeny_index,
                                                            set(restarted_tasks).union(deleted_tasks).union(
                                                                tasks_to_restart))
             stale_topics = dict_union(stale_topics, affected_topics, lambda a, b: min(a, b))
             if not len(batch_reads) <= 1:
                 print()
             if batch_reads:
+                currently_stale_topics = set(topic for topic, start_offset in stale_topics.items() if
+                                             start_offset <= engine.elapsed_time)
                 for i, read_graph in enumerate(batch_reads[0]):
                     for read in EventGraph.to_set(read_graph):
                         if read.progeny in restarted_tasks or read.progeny in deleted_tasks:
                             continue
-                        if set(read.value).intersection(set(topic for topic, start_offset in stale_topics.items() if
-                                                            start_offset <= engine.elapsed_time)):
+                        if not currently_stale_topics.isdisjoint(read.value):
                             tasks_to_restart.add(read.progeny)
                     if batch_reads[0][i + 1:]:
                         engine.schedule.schedule(engine.elapsed_time, batch_reads[0][i + 1:])
@@ -325,8 +377,8 @@ def simulate(
                     caller_history = [(t - call_time, y) for t, y in caller_history]
                     caller_history = [x for x in caller_history if not EventGraph.is_empty(x[1])]
                     saved_caller_events[caller_task] = caller_history
-                    future_events_from_previous_sim = filter_history_discard_after_spawn(
-                        future_events_from_previous_sim, restarted_task, {caller_task})
+                    future_events_from_previous_sim = deque(filter_history_discard_after_spawn(
+                        future_events_from_previous_sim, restarted_task, {caller_task}))
             for task in batch_tasks:
                 engine.schedule.schedule(engine.elapsed_time, task)
         else:  # If there are no tasks to restart
@@ -344,7 +396,8 @@ def simulate(
                 else:
                     history = engine.events
                 task_status, event_graph = engine.step(
-                    task, TaskFrame(engine.elapsed_time, history, task=task)
+                    task, TaskFrame(engine.elapsed_time, history, task=task, read_atoms=engine.read_atoms,
+                                    topics_memo=engine.topics_memo)
                 )
                 if type(task_status) == Completed:
                     """
@@ -355,8 +408,8 @@ def simulate(
                         if old_task in old_task_parent_called:
                             events_to_add = [(t + engine.elapsed_time, y) for t, y in
                                              saved_caller_events[old_task_parent_called[old_task]]]
-                            future_events_from_previous_sim = overlay_histories(future_events_from_previous_sim,
-                                                                                events_to_add)
+                            future_events_from_previous_sim = deque(overlay_histories(future_events_from_previous_sim,
+                                                                                      events_to_add))
                     # for t, batch in list(engine.schedule._schedule.items()):
                     #     for eg in batch:
                     #         if EventGraph.is_event_graph(eg):
@@ -392,11 +445,13 @@ def simulate(
             Include old events in the batch_event graph
             """
             previous_eg = EventGraph.empty()
+            discarded_tasks = set(restarted_tasks).union(deleted_tasks)
+            memo = {}
             while future_events_from_previous_sim and future_events_from_previous_sim[0][0] == resume_time:
                 previous_eg = EventGraph.sequentially(previous_eg,
-                                                      EventGraph.filter_p(future_events_from_previous_sim.pop(0)[1],
-                                                                          lambda evt: evt.progeny not in set(
-                                                                              restarted_tasks).union(deleted_tasks)))
+                                                      EventGraph.filter_p(future_events_from_previous_sim.popleft()[1],
+                                                                          lambda evt: evt.progeny not in discarded_tasks,
+                                                                          memo))
             batch_event_graph = EventGraph.concurrently(batch_event_graph, previous_eg)
             if future_events_from_previous_sim and future_events_from_previous_sim[0][0] == resume_time:
                 raise ValueError("Duplicate resume time in old_events:", resume_time)
@@ -423,23 +478,18 @@ def simulate(
             """
             newly_stale_readers = set()
             for start_offset, event_graph in future_events_from_previous_sim:
-                filtered = EventGraph.filter_p(
+                readers = EventGraph.filter_to_set(
                     event_graph,
                     lambda evt: evt.topic == SPECIAL_READ_TOPIC
                                 and evt.progeny not in deleted_tasks
-                                and set(evt.value).intersection(newly_invalidated_topics),
+                                and not newly_invalidated_topics.isdisjoint(evt.value),
+                    lambda evt: evt.progeny,
                 )
-                newly_stale_readers.update(EventGraph.to_set(filtered, lambda evt: evt.progeny))
+                newly_stale_readers.update(readers)
             if newly_stale_readers:
                 # Filter out all events from these tasks in the future
-                for i in range(len(future_events_from_previous_sim)):
-                    start_offset, event_graph = future_events_from_previous_sim[i]
-                    future_events_from_previous_sim[i] = (
-                        start_offset,
-                        EventGraph.filter_p(event_graph, lambda evt: evt.progeny not in newly_stale_readers),
-                    )
-                future_events_from_previous_sim = [x for x in future_events_from_previous_sim if
-                                                   not EventGraph.is_empty(x[1])]
+                future_events_from_previous_sim = deque(
+                    filter_history_discard(future_events_from_previous_sim, newly_stale_readers))
                 # TODO What about events emitted by children?
 
             """
@@ -450,7 +500,9 @@ def simulate(
             condition_reads = EventGraph.empty()
             while old_awaiting_conditions:
                 condition, task = old_awaiting_conditions.pop()
-                engine.current_task_frame = TaskFrame(engine.elapsed_time, engine.events, task=task)
+                engine.current_task_frame = TaskFrame(engine.elapsed_time, engine.events, task=task,
+                                                      read_atoms=engine.read_atoms,
+                                                      topics_memo=engine.topics_memo)
                 if condition():
                     engine.schedule.schedule(engine.elapsed_time, task)
                 else:
@@ -465,7 +517,7 @@ def simulate(
     payload = {
         "events": list(engine.events),
         "spans": spans,
-        "plan_directive_to_task": {hashable_directive(y): x for x, y in engine.task_directives.items()},
+        "plan_directive_to_task": engine.plan_directive_to_task,
         "task_directives": engine.task_directives,
         "task_children_called": engine.task_children_called,
         "task_children_spawned": engine.task_children_spawned,
@@ -485,7 +537,7 @@ def simulate(
             (old_task_directives[task], old_task_directives[task].start_time, find_end_time(engine.events, task)))
 
     return filtered_spans, collapse_simultaneous(
-        without_special_events(filter_history_discard(engine.events, deleted_tasks)), EventGraph.sequentially), payload
+        without_special_events(engine.events, deleted_tasks), EventGraph.sequentially), payload
 
 
 def topic_equals(x):
@@ -598,29 +650,46 @@ def dict_union(a, b, on_conflict=raise_error("No conflict resolution method was
     return res
 
 
-def get_topics_affected_by_tasks(history, tasks):
+def index_topics_by_progeny(history):
+    """
+    Indexes an event history by the task that emitted each event, so that get_topics_affected_by_tasks does not need
+    to search the whole history.
+
+    :param history: An event history to index
+    :return: A dictionary from task to a dictionary from topic to (i, start_offset), where history[i] is the last
+    entry in which that task emitted an event to that topic
+    """
+    res = {}
+    memo = {}
+    for i, (start_offset, event_graph) in enumerate(history):
+        for task, topic in EventGraph.to_set(event_graph, lambda evt: (evt.progeny, evt.topic), memo):
+            if task not in res:
+                res[task] = {}
+            res[task][topic] = (i, start_offset)
+    return res
+
+
+def get_topics_affected_by_tasks(progeny_index, tasks):
     """
     Finds all topics to which the given tasks have ever emitted events.
 
-    :param history: An event history to search
+    :param progeny_index: An event history, indexed by index_topics_by_progeny
     :param tasks: The tasks whose events to search for
     :return: A dictionary from topic to time at which it was affected
     """
-    res = {}
-    for start_offset, event_graph in history:
-        filtered = EventGraph.filter_p(
-            event_graph,
-            lambda evt: evt.progeny in tasks
-        )
-        for topic in EventGraph.to_set(filtered, lambda evt: evt.topic):
-            res[topic] = start_offset
-    return res
+    latest = {}
+    for task in tasks:
+        for topic, position in progeny_index.get(task, {}).items():
+            if topic not in latest or position > latest[topic]:
+                latest[topic] = position
+    return {topic: start_offset for topic, (_, start_offset) in latest.items()}
 
 
 def filter_history_discard(history, deleted_tasks):
     res = []
+    memo = {}
     for x, eg in history:
-        filtered = EventGraph.filter_p(eg, lambda evt: evt.progeny not in deleted_tasks)
+        filtered = EventGraph.filter_p(eg, lambda evt: evt.progeny not in deleted_tasks, memo)
         if not EventGraph.is_empty(filtered):
             res.append((x, filtered))
     return res
@@ -646,8 +715,9 @@ def filter_history_discard_after_spawn(history, spawned_task, deleted_tasks):
 
 def filter_history_keep(history, tasks_to_keep):
     res = []
+    memo = {}
     for x, eg in history:
-        filtered = EventGraph.filter_p(eg, lambda evt: evt.progeny in tasks_to_keep)
+        filtered = EventGraph.filter_p(eg, lambda evt: evt.progeny in tasks_to_keep, memo)
         if not EventGraph.is_empty(filtered):
             res.append((x, filtered))
     return res
@@ -685,7 +755,7 @@ def restart_stale_tasks(
                                            engine.elapsed_time, all_old_events, spawn_event_prefix)
         register_engine(engine)
         engine.task_start_times[task] = old_task_directives[reader_task].start_time
-        engine.task_directives[task] = old_task_directives[reader_task]
+        engine.set_task_directive(task, old_task_directives[reader_task])
         engine.task_inputs[task] = (old_task_directives[reader_task].type, old_task_directives[reader_task].args)
         if type(status) == AwaitCondition:
             engine.awaiting_conditions.append((status.condition, task))
@@ -709,15 +779,16 @@ def step_up_single_task(register_engine, model_class, directive_type, start_offs
     engine.register_model(model_class)  # creates a new instance of the model class
     register_engine(
         engine)  # this is a hook for the called to be able to hold a reference to the engine. Called here to give a chance to override activities for testing.
+    engine.register_activity_types()
     task = engine.defer(directive_type, start_offset, arguments)
     elapsed_time = start_offset
-    future_history = list(history)
+    future_history = deque(history)
     past_history = list()
     status = Delay(0)
     first_step = True
     while elapsed_time < stop_time:
         while future_history and future_history[0][0] < elapsed_time:
-            past_history.append(future_history.pop(0))
+            past_history.append(future_history.popleft())
         if first_step:
             task_frame = TaskFrame(elapsed_time, past_history + [spawn_prefix], task=task)
             first_step = False
@@ -737,7 +808,7 @@ def step_up_single_task(register_engine, model_class, directive_type, start_offs
             if status.condition():
                 condition_satisfied = True
             while future_history and not condition_satisfied:
-                past_history.append(future_history.pop(0))
+                past_history.append(future_history.popleft())
                 elapsed_time = past_history[-1][0]
                 if elapsed_time >= stop_time:
                     return task, status
@@ -776,9 +847,10 @@ def graft(history, new_events, old_task, new_task):
 
 
 def graft_helper(event_graph, new_events, old_task, new_task, suffix=EventGraph.empty()):
-    if type(event_graph) == EventGraph.Empty:
+    kind = event_graph.KIND
+    if kind == EMPTY_KIND:
         return EventGraph.empty(), False
-    if type(event_graph) == EventGraph.Atom:
+    if kind == ATOM_KIND:
         evt = event_graph.value
         if evt.topic == SPECIAL_SPAWN_TOPIC and evt.value == old_task:
             return EventGraph.sequentially(
@@ -786,11 +858,11 @@ def graft_helper(event_graph, new_events, old_task, new_task, suffix=EventGraph.
                 EventGraph.concurrently(new_events, suffix)), True
         else:
             return event_graph, False
-    if type(event_graph) == EventGraph.Sequentially:
+    if kind == SEQUENTIALLY_KIND:
         prefix, prefix_found = graft_helper(event_graph.prefix, new_events, old_task, new_task)
         suffix, suffix_found = graft_helper(event_graph.suffix, new_events, old_task, new_task)
         return EventGraph.sequentially(prefix, suffix), prefix_found or suffix_found
-    if type(event_graph) == EventGraph.Concurrently:
+    if kind == CONCURRENTLY_KIND:
         left, left_found = graft_helper(event_graph.left, new_events, old_task, new_task)
         right, right_found = graft_helper(event_graph.right, new_events, old_task, new_task)
         return EventGraph.concurrently(left, right), left_found or right_found
@@ -802,15 +874,16 @@ def find_all_dominated_by(event_graph, old_task):
     x is dominated if all paths from origin to x lead through spawn(old_task)
     not dominated is the original graph without the dominated nodes
     """
-    if type(event_graph) == EventGraph.Empty:
+    kind = event_graph.KIND
+    if kind == EMPTY_KIND:
         return EventGraph.empty(), EventGraph.empty(), False
-    if type(event_graph) == EventGraph.Atom:
+    if kind == ATOM_KIND:
         evt = event_graph.value
         if evt.topic == SPECIAL_SPAWN_TOPIC and evt.value == old_task:
             return EventGraph.empty(), event_graph, True
         else:
             return event_graph, EventGraph.empty(), False
-    if type(event_graph) == EventGraph.Sequentially:
+    if kind == SEQUENTIALLY_KIND:
         prefix_dominated, prefix_not_dominated, prefix_found = find_all_dominated_by(event_graph.prefix, old_task)
         suffix_dominated, suffix_not_dominated, suffix_found = find_all_dominated_by(event_graph.suffix, old_task)
         if prefix_found:
@@ -818,7 +891,7 @@ def find_all_dominated_by(event_graph, old_task):
         if suffix_found:
             return suffix_dominated, EventGraph.sequentially(event_graph.prefix, suffix_not_dominated), True
         return EventGraph.empty(), event_graph, False
-    if type(event_graph) == EventGraph.Concurrently:
+    if kind == CONCURRENTLY_KIND:
         left_dominated, left_not_dominated, left_found = find_all_dominated_by(event_graph.left, old_task)
         right_dominated, right_not_dominated, right_found = find_all_dominated_by(event_graph.right, old_task)
         if left_found:
@@ -848,14 +921,15 @@ def get_prefix(event_graph, f):
     Returns the prefix up to and not including f, if f is found
     Otherwise, returns None.
     """
-    if type(event_graph) == EventGraph.Empty:
+    kind = event_graph.KIND
+    if kind == EMPTY_KIND:
         return None
-    if type(event_graph) == EventGraph.Atom:
+    if kind == ATOM_KIND:
         if f(event_graph.value):
             return EventGraph.empty()
         else:
             return None
-    if type(event_graph) == EventGraph.Sequentially:
+    if kind == SEQUENTIALLY_KIND:
         res_p = get_prefix(event_graph.prefix, f)
         res_s = get_prefix(event_graph.suffix, f)
         if res_p is None and res_s is None:
@@ -863,7 +937,7 @@ def get_prefix(event_graph, f):
         if not res_p is None:
             return res_p
         return EventGraph.sequentially(event_graph.prefix, res_s)
-    if type(event_graph) == EventGraph.Concurrently:  # TODO: Untested
+    if kind == CONCURRENTLY_KIND:  # TODO: Untested
         res_l = get_prefix(event_graph.left, f)
         res_r = get_prefix(event_graph.right, f)
         if res_l is not None:
@@ -881,14 +955,15 @@ def get_suffix(event_graph, f):
 
 
 def reverse_event_graph(event_graph):
-    if type(event_graph) == EventGraph.Empty:
+    kind = event_graph.KIND
+    if kind == EMPTY_KIND:
         return event_graph
-    if type(event_graph) == EventGraph.Atom:
+    if kind == ATOM_KIND:
         return event_graph
-    if type(event_graph) == EventGraph.Sequentially:
+    if kind == SEQUENTIALLY_KIND:
         return EventGraph.sequentially(reverse_event_graph(event_graph.suffix),
                                        reverse_event_graph(event_graph.prefix))  # swapped
-    if type(event_graph) == EventGraph.Concurrently:  # TODO: Untested
+    if kind == CONCURRENTLY_KIND:  # TODO: Untested
         return EventGraph.concurrently(reverse_event_graph(event_graph.left), reverse_event_graph(event_graph.right))
 
     raise ValueError("Not an event_graph: " + str(event_graph))
@@ -904,14 +979,18 @@ def remove_task_from_spans(spans):
     return filtered_spans
 
 
-def without_special_events(events):
+def is_special_event(evt):
+    return evt.topic in (SPECIAL_READ_TOPIC, SPECIAL_SPAWN_TOPIC) or (type(evt.topic) == tuple and evt.topic[0] == "FINISH")
+
+
+def without_special_events(events, deleted_tasks=()):
+    """
+    Drops special events, and events emitted by deleted_tasks, in a single walk of each entry of events
+    """
     non_read_events = []
+    memo = {}
     for x, y in events:
-        filtered = EventGraph.filter_p(
-            y,
-            lambda evt: evt.topic not in (SPECIAL_READ_TOPIC, SPECIAL_SPAWN_TOPIC)
-                        and not (type(evt.topic) == tuple and evt.topic[0] == "FINISH"),
-        )
+        filtered = EventGraph.filter_p(y, lambda evt: not (evt.progeny in deleted_tasks or is_special_event(evt)), memo)
         if not EventGraph.is_empty(filtered):
             non_read_events.append((x, filtered))
     return non_read_events
@@ -919,18 +998,18 @@ def without_special_events(events):
 
 def simulate_incremental(register_engine, model_class, new_plan, old_plan, payload):
     unchanged_directives, deleted_directives, added_directives = diff(old_plan.directives, new_plan.directives)
-    deleted_tasks = [payload["plan_directive_to_task"][hashable_directive(x)] for x in deleted_directives]
+    deleted_tasks = set(payload["plan_directive_to_task"][hashable_directive(x)] for x in deleted_directives)
 
-    worklist = list(deleted_tasks)
+    # Children of deleted tasks are deleted too. Each task is visited at most once
+    worklist = deque(deleted_tasks)
     while worklist:
-        task = worklist.pop()
-        if task in payload["task_children_spawned"]:
-            # TODO: Untested
-            deleted_tasks.extend(payload["task_children_spawned"][task])
-            worklist.extend(payload["task_children_spawned"][task])
-        if task in payload["task_children_called"]:
-            deleted_tasks.extend(payload["task_children_called"][task])
-            worklist.extend(payload["task_children_called"][task])
+        task = worklist.popleft()
+        for children in (payload["task_children_spawned"], payload["task_children_called"]):
+            # TODO: Untested for spawned children
+            for child in children.get(task, ()):
+                if child not in deleted_tasks:
+                    deleted_tasks.add(child)
+                    worklist.append(child)
 
     new_spans, new_events, new_payload = simulate(
         register_engine,
@@ -945,14 +1024,14 @@ def simulate_incremental(register_engine, model_class, new_plan, old_plan, paylo
 
     old_spans = list(payload["spans"])
 
-    deleted_tasks.extend(new_payload["deleted_tasks"])
+    deleted_tasks.update(new_payload["deleted_tasks"])
     for task in deleted_tasks:
         if task in payload["task_directives"]:
             deleted_directives.append(payload["task_directives"][task])
 
-    for deleted_directive in deleted_directives:
-        old_spans = [x for x in old_spans if x[0] != deleted_directive]
-    old_spans = [x for x in old_spans if x[0][2] not in deleted_tasks]
+    # Spans are keyed either by Directive, or by (directive_type, args, task) when the task had no directive
+    old_spans = [x for x in old_spans if x[0] not in deleted_directives]
+    old_spans = [x for x in old_spans if type(x[0]) == Directive or x[0][2] not in deleted_tasks]
     return (
         sorted(remove_task_from_spans(old_spans) + new_spans, key=lambda x: (x[1], x[2])),
         without_special_events(collapse_simultaneous(new_events, EventGraph.sequentially)),
@@ -965,41 +1044,76 @@ def get_stale_reads(event_graph):
     return stale_reads
 
 
+_ENTER = 0
+_ENTER_SUFFIX = 1  # enter a node with the stale topics on exit from the preceding prefix
+_EXIT_CONCURRENTLY = 2
+
+
 def get_stale_reads_helper(event_graph, stale_topics):
-    if type(event_graph) == EventGraph.Empty:
-        return [], stale_topics
-    if type(event_graph) == EventGraph.Atom:
-        if event_graph.value.topic == SPECIAL_READ_TOPIC and set(event_graph.value.value).intersection(stale_topics):
-            return [event_graph.value], stale_topics
-        elif event_graph.value.topic != SPECIAL_READ_TOPIC:
-            return [], stale_topics.union({event_graph.value.topic})
+    """
+    Returns the reads in event_graph of topics that are stale at the time of the read, in order, along with
+    stale_topics extended by every topic written in event_graph.
+
+    A read sees the topics that were stale on entry, plus those written by anything sequentially before it.
+    Iterative, so that deep event graphs do not exhaust the Python stack. Topic sets are immutable and shared
+    between nodes, and are only copied when a write adds a new topic.
+    """
+    stale_reads = []
+    results = []  # stale topics on exit from each completed node, in post-order
+    worklist = [(_ENTER, event_graph, frozenset(stale_topics))]
+    while worklist:
+        action, node, topics = worklist.pop()
+        if action == _EXIT_CONCURRENTLY:
+            right_topics = results.pop()
+            left_topics = results.pop()
+            results.append(left_topics | right_topics)
+            continue
+        if action == _ENTER_SUFFIX:
+            topics = results.pop()
+        kind = node.KIND
+        if kind == EMPTY_KIND:
+            results.append(topics)
+        elif kind == ATOM_KIND:
+            if node.value.topic == SPECIAL_READ_TOPIC:
+                if not topics.isdisjoint(node.value.value):
+                    stale_reads.append(node.value)
+                results.append(topics)
+            elif node.value.topic in topics:
+                results.append(topics)
+            else:
+                results.append(topics | {node.value.topic})
+        elif kind == SEQUENTIALLY_KIND:
+            # The suffix's exit topics are also those of the whole node, so no exit step is needed
+            worklist.append((_ENTER_SUFFIX, node.suffix, None))
+            worklist.append((_ENTER, node.prefix, topics))
+        elif kind == CONCURRENTLY_KIND:
+            worklist.append((_EXIT_CONCURRENTLY, node, None))
+            worklist.append((_ENTER, node.right, topics))
+            worklist.append((_ENTER, node.left, topics))
         else:
-            return [], stale_topics
-    if type(event_graph) == EventGraph.Sequentially:
-        prefix_stale_reads, prefix_stale_topics = get_stale_reads_helper(event_graph.prefix, stale_topics)
-        suffix_stale_reads, suffix_stale_topics = get_stale_reads_helper(
-            event_graph.suffix, stale_topics.union(prefix_stale_topics)
-        )
-        return prefix_stale_reads + suffix_stale_reads, prefix_stale_topics.union(suffix_stale_topics)
-    if type(event_graph) == EventGraph.Concurrently:
-        left_stale_reads, left_stale_topics = get_stale_reads_helper(event_graph.left, stale_topics)
-        right_stale_reads, right_stale_topics = get_stale_reads_helper(event_graph.right, stale_topics)
-        return left_stale_reads + right_stale_reads, left_stale_topics.union(right_stale_topics)
-    raise ValueError("Not an event_graph: " + str(event_graph))
+            raise ValueError("Not an event_graph: " + str(node))
+    return stale_reads, results.pop()
 
 
 def collapse_simultaneous(history, combiner):
-    sorted_history = sorted(history, key=lambda x: x[0])
-    res = []
-    for start_offset, event_graph in sorted_history:
-        if not res:
-            res.append([start_offset, event_graph])
+    """
+    Combines entries of history that share a start_offset, in the order in which they appear, and returns the result
+    ordered by start_offset. Histories are usually already in order, in which case no sort is needed.
+    """
+    res = {}
+    in_order = True
+    previous_start_offset = None
+    for start_offset, event_graph in history:
+        if start_offset in res:
+            res[start_offset] = combiner(res[start_offset], event_graph)
         else:
-            if start_offset == res[-1][0]:
-                res[-1][1] = combiner(res[-1][1], event_graph)
-            else:
-                res.append([start_offset, event_graph])
-    return [tuple(x) for x in res]
+            res[start_offset] = event_graph
+            if previous_start_offset is not None and start_offset < previous_start_offset:
+                in_order = False
+            previous_start_offset = start_offset
+    if in_order:
+        return list(res.items())
+    return sorted(res.items(), key=lambda x: x[0])
 
 
 def make_generator(f, arguments):
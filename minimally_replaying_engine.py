@@ -24,9 +24,10 @@ def foo():
       delay(epsilon)
 """
 from collections import namedtuple
-import inspect
+import heapq
+import itertools
 
-from protocol import Completed, Delay, AwaitCondition, Call, Directive, tuple_args, make_generator
+from protocol import Completed, Delay, AwaitCondition, Call, Directive, tuple_args, make_generator, make_activity_dispatch
 from event_graph import EventGraph
 
 Event = namedtuple("Event", "topic value")
@@ -55,7 +56,7 @@ class SimulationEngine:
         self.current_task_frame = TaskFrame(self.elapsed_time, self.action_log)
         self.schedule = JobSchedule()
         self.model = None  # Filled in by register_model
-        self.activity_types_by_name = None  # Filled in by register_model
+        self.activity_dispatch = None  # Filled in by register_activity_types
         self.task_start_times = {}
         self.task_directives = {}
         self.task_inputs = {}
@@ -75,9 +76,11 @@ class SimulationEngine:
         Instantiate the model, save, and return that instance
         """
         self.model = cls()
-        self.activity_types_by_name = self.model.get_activity_types()
         return self.model
 
+    def register_activity_types(self):
+        self.activity_dispatch = make_activity_dispatch(self.model.get_activity_types())
+
     def spawn(self, directive_type, arguments):
         """
         Spawn a task, and step it once, recording its actions.
@@ -190,7 +193,7 @@ class SimulationEngine:
         elif directive_type in self.anonymous_tasks:  # oxymoron
             self.tasks[task_id] = self.anonymous_tasks[directive_type]()
         else:
-            self.tasks[task_id] = make_task(self.model, directive_type, args)
+            self.tasks[task_id] = make_task(self.model, self.activity_dispatch, directive_type, args)
 
 class ActionLog:
     def __init__(self, engine, old_action_log):
@@ -271,7 +274,7 @@ class TaskFrame:
         topics = [topic_or_topics] if type(topic_or_topics) != list else topic_or_topics
         self.read_topics.update(topics)
         res = []
-        for start_offset, x in self.get_visible_history():
+        for start_offset, x in self.iter_visible_history():
             filtered = EventGraph.filter(x, topics)
             if not EventGraph.is_empty(filtered):
                 res.append((start_offset, filtered))
@@ -284,22 +287,36 @@ class TaskFrame:
         self.tip = EventGraph.empty()
 
     def get_visible_history(self):
+        return self.history + [self._get_current_history_entry()]
+
+    def iter_visible_history(self):
+        """
+        Like get_visible_history, but without copying the history
+        """
+        yield from self.history
+        yield self._get_current_history_entry()
+
+    def _get_current_history_entry(self):
+        if not self.branches:
+            return self.elapsed_time, self.tip
         res = EventGraph.empty()
         for base, _ in self.branches:
             res = EventGraph.sequentially(res, base)
         res = EventGraph.sequentially(res, self.tip)
-        return self.history + [(self.elapsed_time, res)]
+        return self.elapsed_time, res
 
     def collect(self):
+        if not self.branches:
+            return self.tip
         res = self.tip
         for base, event_graph in reversed(self.branches):
             res = EventGraph.sequentially(base, EventGraph.concurrently(event_graph, res))
         return res
 
 
-def make_task(model, directive_type, arguments):
-    func = model.get_activity_types()[directive_type]
-    if inspect.isgeneratorfunction(func):
+def make_task(model, activity_dispatch, directive_type, arguments):
+    is_generator_function, func = activity_dispatch[directive_type]
+    if is_generator_function:
         return func.__call__(model, **arguments)
     else:
         return make_generator(func, dict(**arguments, model=model))
@@ -307,27 +324,30 @@ def make_task(model, directive_type, arguments):
 
 class JobSchedule:
     def __init__(self):
-        self._schedule = {}
+        self._heap = []  # heap of tuples (start_offset, insertion order, task_id)
+        self._counter = itertools.count()
+        self._scheduled = set()  # task_ids currently in the heap, for duplicate detection
 
     def schedule(self, start_offset, task_id):
-        if start_offset not in self._schedule:
-            self._schedule[start_offset] = []
-        for _, batch in self._schedule.items():
-            if task_id in batch:
-                raise Exception("Double scheduling task: " + str(task_id))
-        self._schedule[start_offset].append(task_id)
+        if task_id in self._scheduled:
+            raise Exception("Double scheduling task: " + str(task_id))
+        self._scheduled.add(task_id)
+        heapq.heappush(self._heap, (start_offset, next(self._counter), task_id))
 
     def peek_next_time(self):
-        return min(self._schedule)
+        return self._heap[0][0]
 
     def get_next_batch(self):
         next_time = self.peek_next_time()
-        res = self._schedule[next_time]
-        del self._schedule[next_time]
+        res = []
+        while self._heap and self._heap[0][0] == next_time:
+            _, _, task_id = heapq.heappop(self._heap)
+            self._scheduled.remove(task_id)
+            res.append(task_id)
         return res
 
     def is_empty(self):
-        return len(self._schedule) == 0
+        return not self._heap
 
 
 class Subscriptions:
@@ -358,6 +378,7 @@ def simulate(register_engine, model_class, plan, action_log=None, anonymous_task
     engine = SimulationEngine(register_engine, action_log=action_log, anonymous_tasks=anonymous_tasks)
     engine.register_model(model_class)
     register_engine(engine)
+    engine.register_activity_types()
 
     for directive in plan.directives:
         engine.defer(directive.type, directive.start_time, directive.args)
@@ -572,7 +593,7 @@ def step_up_task(register_engine, engine, directive_type, arguments, reads, last
     if directive_type in engine.anonymous_tasks:
         task = engine.anonymous_tasks[directive_type]()
     else:
-        task = make_task(engine.model, directive_type, arguments)
+        task = make_task(engine.model, engine.activity_dispatch, directive_type, arguments)
     return ReplayingSimulationEngine(engine).step_up(register_engine, engine, task, reads, last_read)
 
 
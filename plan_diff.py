@@ -1,19 +1,25 @@
+from collections import defaultdict, deque
+
+from protocol import hashable_directive
+
+
 def diff(old_directives, new_directives):
-    old_directives = list(old_directives)
-    new_directives = list(new_directives)
-    unchanged_directives = []
+    """
+    Matches old and new directives by value, treating each plan as a multiset of directives.
+
+    Returns (unchanged, deleted, added). Unchanged directives are the old Directive objects.
+    """
+    old_by_key = defaultdict(deque)
+    for old in old_directives:
+        old_by_key[hashable_directive(old)].append(old)
 
-    any_matched = True
-    while any_matched:
-        # TODO use a more efficient diff algorithm
-        any_matched = False
-        for old in old_directives:
-            for new in new_directives:
-                if old == new:
-                    unchanged_directives.append(old)
-                    new_directives.remove(new)
-                    old_directives.remove(old)
-                    any_matched = True
-    deleted_directives = old_directives
-    added_directives = new_directives
+    unchanged_directives = []
+    added_directives = []
+    for new in new_directives:
+        matches = old_by_key.get(hashable_directive(new))
+        if matches:
+            unchanged_directives.append(matches.popleft())
+        else:
+            added_directives.append(new)
+    deleted_directives = [old for matches in old_by_key.values() for old in matches]
     return unchanged_directives, deleted_directives, added_directives
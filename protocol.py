@@ -1,3 +1,4 @@
+import inspect
 from collections import namedtuple
 from typing import List
 
@@ -17,6 +18,8 @@ Spawn = namedtuple("Spawn", "child_task")
 Completed = namedtuple("Completed", "")
 
 class Plan:
+    __slots__ = ("directives",)
+
     def __init__(self, directives):
         self.directives: List[Directive] = list(directives)
 
@@ -38,4 +41,12 @@ def restore_directive(hashable_directive):
 def make_generator(f, arguments):
     if False:
         yield
-    f(**arguments)
\ No newline at end of file
+    f(**arguments)
+
+def make_activity_dispatch(activity_types_by_name):
+    """
+    Maps each activity type name to (is_generator_function, func), so that make_task needs no per-task inspection.
+    Build it after register_engine, which may override the model's activity types. The activity types must not change
+    afterwards, since model.get_activity_types is not consulted again.
+    """
+    return {name: (inspect.isgeneratorfunction(func), func) for name, func in activity_types_by_name.items()}
@@ -24,10 +24,11 @@ def foo():
       delay(epsilon)
 """
 from collections import namedtuple
-import inspect
+import heapq
+import itertools
 
-from protocol import Completed, Delay, AwaitCondition, Call, Directive, tuple_args, make_generator
-from event_graph import EventGraph
+from protocol import Completed, Delay, AwaitCondition, Call, Directive, tuple_args, make_generator, make_activity_dispatch
+from event_graph import EventGraph, EMPTY
 
 Event = namedtuple("Event", "topic value")
 TaskId = namedtuple("TaskId", "id label")
@@ -51,7 +52,7 @@ class SimulationEngine:
         self.current_task_frame = TaskFrame(self.elapsed_time, self.action_log)
         self.schedule = JobSchedule()
         self.model = None  # Filled in by register_model
-        self.activity_types_by_name = None  # Filled in by register_model
+        self.activity_dispatch = None  # Filled in by register_activity_types
         self.task_start_times = {}
         self.task_directives = {}
         self.task_inputs = {}
@@ -66,9 +67,11 @@ class SimulationEngine:
 
     def register_model(self, cls):
         self.model = cls()
-        self.activity_types_by_name = self.model.get_activity_types()
         return self.model
 
+    def register_activity_types(self):
+        self.activity_dispatch = make_activity_dispatch(self.model.get_activity_types())
+
     def spawn(self, directive_type, arguments):
         task_id = fresh_task_id(str(directive_type) + " " + str(arguments))
         task = self.make_task(task_id, directive_type, arguments)
@@ -152,7 +155,7 @@ class SimulationEngine:
         elif directive_type in self.anonymous_tasks:  # oxymoron
             return self.anonymous_tasks[directive_type]()
         else:
-            return make_task(self.model, directive_type, args)
+            return make_task(self.model, self.activity_dispatch, directive_type, args)
 
 class ActionLog:
     def __init__(self, engine, old_action_log):
@@ -229,9 +232,9 @@ class TaskFrame:
     def read(self, topic_or_topics, function):
         topics = [topic_or_topics] if type(topic_or_topics) != list else topic_or_topics
         res = []
-        for start_offset, x in self.get_visible_history():
+        for start_offset, x in self.iter_visible_history():
             filtered = EventGraph.filter(x, topics)
-            if type(filtered) != EventGraph.Empty:
+            if filtered is not EMPTY:
                 res.append((start_offset, filtered))
         res = function(res)
         self.action_log.read(self.task_id, topics, function, res)
@@ -242,22 +245,36 @@ class TaskFrame:
         self.tip = EventGraph.empty()
 
     def get_visible_history(self):
+        return self.history + [self._get_current_history_entry()]
+
+    def iter_visible_history(self):
+        """
+        Like get_visible_history, but without copying the history
+        """
+        yield from self.history
+        yield self._get_current_history_entry()
+
+    def _get_current_history_entry(self):
+        if not self.branches:
+            return self.elapsed_time, self.tip
         res = EventGraph.empty()
         for base, _ in self.branches:
             res = EventGraph.sequentially(res, base)
         res = EventGraph.sequentially(res, self.tip)
-        return self.history + [(self.elapsed_time, res)]
+        return self.elapsed_time, res
 
     def collect(self):
+        if not self.branches:
+            return self.tip
         res = self.tip
         for base, event_graph in reversed(self.branches):
             res = EventGraph.sequentially(base, EventGraph.concurrently(event_graph, res))
         return res
 
 
-def make_task(model, directive_type, arguments):
-    func = model.get_activity_types()[directive_type]
-    if inspect.isgeneratorfunction(func):
+def make_task(model, activity_dispatch, directive_type, arguments):
+    is_generator_function, func = activity_dispatch[directive_type]
+    if is_generator_function:
         return func.__call__(model, **arguments)
     else:
         return make_generator(func, dict(**arguments, model=model))
@@ -265,33 +282,37 @@ def make_task(model, directive_type, arguments):
 
 class JobSchedule:
     def __init__(self):
-        self._schedule = {}
+        self._heap = []  # heap of tuples (start_offset, insertion order, task_id)
+        self._counter = itertools.count()
+        self._scheduled = set()  # task_ids currently in the heap, for duplicate detection
 
     def schedule(self, start_offset, task_id):
-        if start_offset not in self._schedule:
-            self._schedule[start_offset] = []
-        for _, batch in self._schedule.items():
-            if task_id in batch:
-                raise Exception("Double scheduling task: " + str(task_id))
-        self._schedule[start_offset].append(task_id)
+        if task_id in self._scheduled:
+            raise Exception("Double scheduling task: " + str(task_id))
+        self._scheduled.add(task_id)
+        heapq.heappush(self._heap, (start_offset, next(self._counter), task_id))
 
     def peek_next_time(self):
-        return min(self._schedule)
+        return self._heap[0][0]
 
     def get_next_batch(self):
         next_time = self.peek_next_time()
-        res = self._schedule[next_time]
-        del self._schedule[next_time]
+        res = []
+        while self._heap and self._heap[0][0] == next_time:
+            _, _, task_id = heapq.heappop(self._heap)
+            self._scheduled.remove(task_id)
+            res.append(task_id)
         return res
 
     def is_empty(self):
-        return len(self._schedule) == 0
+        return not self._heap
 
 
 def simulate(register_engine, model_class, plan, action_log=None, anonymous_tasks=None):
     engine = SimulationEngine(register_engine, action_log=action_log, anonymous_tasks=anonymous_tasks)
     engine.register_model(model_class)
     register_engine(engine)
+    engine.register_activity_types()
 
     for directive in plan.directives:
         engine.defer(directive.type, directive.start_time, directive.args)
@@ -306,7 +327,7 @@ def simulate(register_engine, model_class, plan, action_log=None, anonymous_task
             task_status, event_graph = engine.step(task_id, engine.tasks[task_id])
             batch_event_graph = EventGraph.concurrently(batch_event_graph, event_graph)
         engine.current_task_frame = TaskFrame(engine.elapsed_time, engine.action_log, history=engine.events)
-        if type(batch_event_graph) != EventGraph.Empty:
+        if batch_event_graph is not EMPTY:
             if engine.events and engine.events[-1][0] == engine.elapsed_time:
                 engine.events[-1] = (engine.elapsed_time, EventGraph.sequentially(engine.events[-1][1], batch_event_graph))
             else:
@@ -453,7 +474,7 @@ def step_up_task(register_engine, engine, directive_type, arguments, reads, last
     if directive_type in engine.anonymous_tasks:
         task = engine.anonymous_tasks[directive_type]()
     else:
-        task = make_task(engine.model, directive_type, arguments)
+        task = make_task(engine.model, engine.activity_dispatch, directive_type, arguments)
     return ReplayingSimulationEngine(engine).step_up(register_engine, engine, task, reads, last_read)
 
 
@@ -1,9 +1,33 @@
 from collections import namedtuple
+from contextlib import contextmanager
 
 from protocol import Delay, AwaitCondition, EventGraph, Call, make_generator
 
 sim_engine = None
 
+
+def register_engine(engine):
+    """
+    Makes engine the target of spawn, and of reads and emits on model resources. Engines call this, via the
+    register_engine argument of simulate, whenever they switch which engine is running tasks
+    """
+    global sim_engine
+    sim_engine = engine
+
+
+@contextmanager
+def use_engine(engine):
+    """
+    Registers engine for the duration of the with block, then restores the previously registered engine
+    """
+    previous_engine = sim_engine
+    register_engine(engine)
+    try:
+        yield engine
+    finally:
+        register_engine(previous_engine)
+
+
 def spawn(*args, **kwargs):
     sim_engine.spawn(*args, **kwargs)
 
@@ -1,84 +1,103 @@
+import functools
 import inspect
 
+import pytest
+
 import engine as sim
 # import incremental_engine as incremental_sim
 # import replaying_engine as incremental_sim
 import minimally_replaying_engine as incremental_sim
 import model
 import sim as facade
-from protocol import Plan, Directive, hashable_directive, make_generator
+from plan_diff import diff
+from protocol import Plan, Directive, hashable_directive, make_generator, restore_directive
 
 model_ = model
 
+# Tests do not depend on each other or on their order: every simulate registers its own engine with the facade, and
+# the only state shared between tests (the plans and overrides below, and the memoized reference results) is never
+# mutated. They can be distributed across worker processes, e.g. with pytest-xdist's `pytest -n auto`, in which case
+# each worker keeps its own reference results.
+
+# Plans shared by several tests. Engines only read plans, so they are built once, at import
+_BASELINE_PLAN = Plan(
+    [
+        Directive("my_other_activity", 10, {}),
+        Directive("my_activity", 20, {"param1": 5}),
+        Directive("my_decomposing_activity", 40, {}),
+        Directive("caller_activity", 50, {}),
+        Directive("emit_event", 99, {"topic": "y", "value": 2, "_": 1}),
+        Directive("await_condition_set_by_child", 100, {"_": 2}),
+        Directive("condition_becomes_true_with_no_steps", 101, {}),
+        Directive("emit_event", 300, {"topic": "q", "value": 3, "_": 3}),
+        Directive("emit_event", 300, {"topic": "q", "value": 4, "_": 4}),
+        Directive("emit_event", 300, {"topic": "q", "value": 5, "_": 5}),
+        Directive("emit_event", 300, {"topic": "q", "value": 6, "_": 6}),
+        Directive("emit_event", 300, {"topic": "q", "value": 7, "_": 7}),
+        Directive("emit_event", 300, {"topic": "q", "value": 8, "_": 8}),
+        Directive("read_topic", 300, {"topic": "q", "_": 9}),
+        Directive("read_topic", 300, {"topic": "x", "_": 10}),
+    ]
+)
+
+_MORE_COMPLEX_PLAN = Plan(
+    [
+        Directive("my_other_activity", 10, {}),
+        Directive("my_activity", 20, {"param1": 5}),
+        Directive("caller_activity", 50, {}),
+    ]
+)
+
+
+# Expected results of simulating _BASELINE_PLAN. Tuples, since these are shared at module level and must not be mutated
+_EXPECTED_BASELINE_EVENTS = (
+    (20, "x=50"),
+    (25, "x=55"),
+    (30, "x=60;y=10"),
+    (35, "x=55;y=9;y=3.0"),
+    (40, "x=55;(x=57|y=13)"),
+    (41, "x=55|y=10"),
+    (50, "x=100;x=99;x=98"),
+    (99, "y=2"),
+    (100, "x=9;x=10;x=11"),
+    (101, 'x=101'),
+    (200, 'x=200'),
+    (300,
+     "history=[(20, 'x=50'), (25, 'x=55'), (30, 'x=60'), (35, 'x=55'), (40, 'x=55;x=57'), (41, 'x=55'), (50, 'x=100;x=99;x=98'), (100, 'x=9;x=10;x=11'), (101, 'x=101'), (200, 'x=200')]|history=[]|q=3|q=4|q=5|q=6|q=7|q=8"),
+)
+
+_EXPECTED_BASELINE_SPANS = (
+    (Directive(type="my_other_activity", start_time=10, args={}), 10, 35),
+    (Directive(type="my_activity", start_time=20, args={"param1": 5}), 20, 35),
+    (Directive(type="my_child_activity", start_time=40, args={}), 40, 41),
+    (Directive(type="my_decomposing_activity", start_time=40, args={}), 40, 41),
+    (Directive(type="callee_activity", start_time=50, args={"value": 99}), 50, 50),
+    (Directive(type="caller_activity", start_time=50, args={}), 50, 50),
+    (Directive(type='emit_event', start_time=99, args={'topic': 'y', 'value': 2, '_': 1}), 99, 99),
+    (Directive(type='maybe_delay_then_emit', start_time=100, args={'_': 2}), 100, 103),
+    (Directive(type='await_condition_set_by_child', start_time=100, args={'_': 2}), 100, 105),
+    (Directive(type='condition_becomes_true_with_no_steps', start_time=101, args={}), 101, 200),
+    (Directive(type='emit_event', start_time=300, args={'topic': 'q', 'value': 3, '_': 3}), 300, 300),
+    (Directive(type='emit_event', start_time=300, args={'topic': 'q', 'value': 4, '_': 4}), 300, 300),
+    (Directive(type='emit_event', start_time=300, args={'topic': 'q', 'value': 5, '_': 5}), 300, 300),
+    (Directive(type='emit_event', start_time=300, args={'topic': 'q', 'value': 6, '_': 6}), 300, 300),
+    (Directive(type='emit_event', start_time=300, args={'topic': 'q', 'value': 7, '_': 7}), 300, 300),
+    (Directive(type='emit_event', start_time=300, args={'topic': 'q', 'value': 8, '_': 8}), 300, 300),
+    (Directive(type='read_topic', start_time=300, args={'topic': 'q', '_': 9}), 300, 300),
+    (Directive(type='read_topic', start_time=300, args={'topic': 'x', '_': 10}), 300, 300),
+)
+
 
 def test_baseline():
     run_baseline(sim)
 
 
 def run_baseline(sim):
-    def register_engine(engine):
-        facade.sim_engine = engine
+    spans, sim_events, _ = sim.simulate(facade.register_engine, model.Model, _BASELINE_PLAN)
 
-    spans, sim_events, _ = sim.simulate(
-        register_engine,
-        model.Model,
-        Plan(
-            [
-                Directive("my_other_activity", 10, {}),
-                Directive("my_activity", 20, {"param1": 5}),
-                Directive("my_decomposing_activity", 40, {}),
-                Directive("caller_activity", 50, {}),
-                Directive("emit_event", 99, {"topic": "y", "value": 2, "_": 1}),
-                Directive("await_condition_set_by_child", 100, {"_": 2}),
-                Directive("condition_becomes_true_with_no_steps", 101, {}),
-                Directive("emit_event", 300, {"topic": "q", "value": 3, "_": 3}),
-                Directive("emit_event", 300, {"topic": "q", "value": 4, "_": 4}),
-                Directive("emit_event", 300, {"topic": "q", "value": 5, "_": 5}),
-                Directive("emit_event", 300, {"topic": "q", "value": 6, "_": 6}),
-                Directive("emit_event", 300, {"topic": "q", "value": 7, "_": 7}),
-                Directive("emit_event", 300, {"topic": "q", "value": 8, "_": 8}),
-                Directive("read_topic", 300, {"topic": "q", "_": 9}),
-                Directive("read_topic", 300, {"topic": "x", "_": 10}),
-            ]
-        ),
-    )
+    assert tuple(history_strings(sim_events)) == _EXPECTED_BASELINE_EVENTS
 
-    assert [(x, sim.EventGraph.to_string(y)) for x, y in sim_events] == [
-        (20, "x=50"),
-        (25, "x=55"),
-        (30, "x=60;y=10"),
-        (35, "x=55;y=9;y=3.0"),
-        (40, "x=55;(x=57|y=13)"),
-        (41, "x=55|y=10"),
-        (50, "x=100;x=99;x=98"),
-        (99, "y=2"),
-        (100, "x=9;x=10;x=11"),
-        (101, 'x=101'),
-        (200, 'x=200'),
-        (300,
-         "history=[(20, 'x=50'), (25, 'x=55'), (30, 'x=60'), (35, 'x=55'), (40, 'x=55;x=57'), (41, 'x=55'), (50, 'x=100;x=99;x=98'), (100, 'x=9;x=10;x=11'), (101, 'x=101'), (200, 'x=200')]|history=[]|q=3|q=4|q=5|q=6|q=7|q=8")
-    ]
-
-    assert spans == [
-        (Directive(type="my_other_activity", start_time=10, args={}), 10, 35),
-        (Directive(type="my_activity", start_time=20, args={"param1": 5}), 20, 35),
-        (Directive(type="my_child_activity", start_time=40, args={}), 40, 41),
-        (Directive(type="my_decomposing_activity", start_time=40, args={}), 40, 41),
-        (Directive(type="callee_activity", start_time=50, args={"value": 99}), 50, 50),
-        (Directive(type="caller_activity", start_time=50, args={}), 50, 50),
-        (Directive(type='emit_event', start_time=99, args={'topic': 'y', 'value': 2, '_': 1}), 99, 99),
-        (Directive(type='maybe_delay_then_emit', start_time=100, args={'_': 2}), 100, 103),
-        (Directive(type='await_condition_set_by_child', start_time=100, args={'_': 2}), 100, 105),
-        (Directive(type='condition_becomes_true_with_no_steps', start_time=101, args={}), 101, 200),
-        (Directive(type='emit_event', start_time=300, args={'topic': 'q', 'value': 3, '_': 3}), 300, 300),
-        (Directive(type='emit_event', start_time=300, args={'topic': 'q', 'value': 4, '_': 4}), 300, 300),
-        (Directive(type='emit_event', start_time=300, args={'topic': 'q', 'value': 5, '_': 5}), 300, 300),
-        (Directive(type='emit_event', start_time=300, args={'topic': 'q', 'value': 6, '_': 6}), 300, 300),
-        (Directive(type='emit_event', start_time=300, args={'topic': 'q', 'value': 7, '_': 7}), 300, 300),
-        (Directive(type='emit_event', start_time=300, args={'topic': 'q', 'value': 8, '_': 8}), 300, 300),
-        (Directive(type='read_topic', start_time=300, args={'topic': 'q', '_': 9}), 300, 300),
-        (Directive(type='read_topic', start_time=300, args={'topic': 'x', '_': 10}), 300, 300),
-    ]
+    assert tuple(spans) == _EXPECTED_BASELINE_SPANS
 
     assert compute_profiles(model.Model(), sim_events) == {
         "x": [(0, 55), (20, 50), (25, 55), (30, 60), (35, 55), (40, 57), (41, 55), (50, 98), (99, 98), (100, 11), (101, 101), (200, 200), (300, 200)],
@@ -87,47 +106,60 @@ def run_baseline(sim):
     }
 
 
+def history_strings(events):
+    return [(x, sim.EventGraph.to_string(y)) for x, y in events]
+
+
 def compute_profiles(model, sim_events):
     engine = sim.SimulationEngine()
-    facade.sim_engine = engine
     engine.events = []
+    # The task frame holds engine.events by reference, so one frame serves every step
     engine.current_task_frame = sim.TaskFrame(engine.elapsed_time, history=engine.events)
-    profiles = {}
-    for attribute in model.attributes():
-        profiles[attribute] = []
-    for attribute in model.attributes():
-        profiles[attribute].append((0, getattr(model, attribute).get()))
-    for start_offset, event_graph in sim_events:
-        engine.elapsed_time = start_offset
-        engine.events.append((start_offset, event_graph))
-        engine.current_task_frame = sim.TaskFrame(start_offset, history=engine.events)
-        for attribute in model.attributes():
-            profiles[attribute].append((start_offset, getattr(model, attribute).get()))
-    return profiles
+    attributes = list(model.attributes())
+    getters = [getattr(model, attribute).get for attribute in attributes]
+    # One column of times shared by all attributes, and one column of values per attribute. The (time, value) pairs
+    # are only built once, at the end
+    times = [0] * (len(sim_events) + 1)
+    columns = [[None] * len(times) for _ in attributes]
+    with facade.use_engine(engine):
+        for column, get in zip(columns, getters):
+            column[0] = get()
+        # The history only ever grows by appending entries of sim_events, which are reused as-is. It cannot be
+        # preallocated, since reads walk the whole of it
+        append_to_history = engine.events.append
+        task_frame = engine.current_task_frame
+        for i, entry in enumerate(sim_events, start=1):
+            start_offset = entry[0]
+            engine.elapsed_time = start_offset
+            append_to_history(entry)
+            task_frame.elapsed_time = start_offset
+            times[i] = start_offset
+            for column, get in zip(columns, getters):
+                column[i] = get()
+    return {attribute: list(zip(times, column)) for attribute, column in zip(attributes, columns)}
+
+
+def test_plan_diff():
+    unchanged, deleted, added = diff(
+        [
+            Directive("emit_event", 1, {"topic": "x", "value": 1}),
+            Directive("emit_event", 1, {"topic": "x", "value": 1}),
+            Directive("no_op", 2, {}),
+        ],
+        [
+            Directive("emit_event", 1, {"value": 1, "topic": "x"}),
+            Directive("no_op", 3, {}),
+        ],
+    )
+    assert unchanged == [Directive("emit_event", 1, {"topic": "x", "value": 1})]
+    assert deleted == [Directive("emit_event", 1, {"topic": "x", "value": 1}), Directive("no_op", 2, {})]
+    assert added == [Directive("no_op", 3, {})]
 
 
 def test_incremental_baseline():
     run_baseline(incremental_sim)
 
 
-def test_incremental():
-    incremental_sim_test_case(
-        Plan(
-            [
-                Directive("callee_activity", 10, {"value": 1}),
-                Directive("callee_activity", 15, {"value": 2}),
-            ]
-        ),
-        Plan(
-            [
-                Directive("callee_activity", 10, {"value": 1}),
-                Directive("callee_activity", 15, {"value": 3}),  # Changed value only
-            ]
-        ),
-        {"callee_activity": error_on_rerun("callee_activity", lambda args: args["value"] == 1)},
-    )
-
-
 def error_on_rerun(name, predicate=lambda kwargs: True):
     def foo(model, **kwargs):
         if predicate(kwargs):
@@ -146,44 +178,57 @@ def make_task(model, directive_type, arguments):
         return make_generator(func, dict(**arguments, model=model))
 
 
-def test_more_complex_add_only():
-    incremental_sim_test_case(
-        Plan(
-            [
-                Directive("my_other_activity", 10, {}),
-                Directive("my_activity", 20, {"param1": 5}),
-                Directive("caller_activity", 50, {}),
-            ]
-        ),
-        Plan(
-            [
-                Directive("my_other_activity", 10, {}),
-                Directive("my_activity", 20, {"param1": 5}),
-                Directive("caller_activity", 50, {}),
-                Directive("my_decomposing_activity", 60, {}),
-            ]
-        ),
-        {x: error_on_rerun(x) for x in ("my_other_activity", "my_activity", "caller_activity")},
-    )
-
-
-def test_more_complex_remove_only():
-    incremental_sim_test_case(
-        Plan(
-            [
-                Directive("my_other_activity", 10, {}),
-                Directive("my_activity", 20, {"param1": 5}),
-                Directive("caller_activity", 50, {}),
-            ]
-        ),
-        Plan(
-            [
-                Directive("my_other_activity", 10, {}),
-                Directive("my_activity", 20, {"param1": 5}),
-            ]
-        ),
-        {x: error_on_rerun(x) for x in ("my_other_activity", "my_activity", "caller_activity")},
-    )
+# Overrides for test cases in which none of the activities of _MORE_COMPLEX_PLAN may be rerun
+_MORE_COMPLEX_OVERRIDES = {x: error_on_rerun(x) for x in ("my_other_activity", "my_activity", "caller_activity")}
+
+
+@pytest.mark.parametrize(
+    "old_plan, new_plan, overrides",
+    [
+        pytest.param(
+            Plan(
+                [
+                    Directive("callee_activity", 10, {"value": 1}),
+                    Directive("callee_activity", 15, {"value": 2}),
+                ]
+            ),
+            Plan(
+                [
+                    Directive("callee_activity", 10, {"value": 1}),
+                    Directive("callee_activity", 15, {"value": 3}),  # Changed value only
+                ]
+            ),
+            {"callee_activity": error_on_rerun("callee_activity", lambda args: args["value"] == 1)},
+            id="changed_value_only",
+        ),
+        pytest.param(
+            _MORE_COMPLEX_PLAN,
+            Plan(
+                [
+                    Directive("my_other_activity", 10, {}),
+                    Directive("my_activity", 20, {"param1": 5}),
+                    Directive("caller_activity", 50, {}),
+                    Directive("my_decomposing_activity", 60, {}),
+                ]
+            ),
+            _MORE_COMPLEX_OVERRIDES,
+            id="more_complex_add_only",
+        ),
+        pytest.param(
+            _MORE_COMPLEX_PLAN,
+            Plan(
+                [
+                    Directive("my_other_activity", 10, {}),
+                    Directive("my_activity", 20, {"param1": 5}),
+                ]
+            ),
+            _MORE_COMPLEX_OVERRIDES,
+            id="more_complex_remove_only",
+        ),
+    ],
+)
+def test_incremental(old_plan, new_plan, overrides):
+    incremental_sim_test_case(old_plan, new_plan, overrides)
 
 
 def test_with_reads():
@@ -763,47 +808,67 @@ TODO test case: await condition when Z passed through the interval of interest b
 
 
 def incremental_sim_test_case(old_plan, new_plan, overrides):
-    def register_engine(engine):
-        facade.sim_engine = engine
+    old_results = incremental_sim.simulate(facade.register_engine, model.Model, old_plan)
+    # Additional assertion for sanity: checks that incremental_sim.simulate and sim.simulate match on the old plan
+    assert_same_results(old_results, simulate_reference(model.Model, old_plan))
 
-    spans_1, events_1, payload = incremental_sim.simulate(register_engine, model.Model, old_plan)
+    _, _, payload = old_results
+    actual_results = incremental_sim.simulate_incremental(
+        make_register_engine_with_overrides(overrides), model.Model, new_plan, old_plan, payload
+    )
+    assert_same_results(actual_results, simulate_reference(model.Model, new_plan))
 
-    def _():
-        """
-        Additional assertion for sanity: checks that incremental_sim.simulate and sim.simulate match on the old plan
-        """
-        expected_old_spans, expected_old_sim_events, _ = sim.simulate(register_engine, model.Model, old_plan)
-        assert [(x, sim.EventGraph.to_string(y)) for x, y in events_1] == [(x, sim.EventGraph.to_string(y)) for x, y in expected_old_sim_events]
-        assert set((hashable_directive(rename(x)), y, z) for x, y, z in spans_1) == set(
-            (hashable_directive(rename(x)), y, z) for x, y, z in expected_old_spans)
-    _()
 
-    expected_spans, expected_sim_events, _ = sim.simulate(register_engine, model.Model, new_plan)
+def assert_same_results(actual, expected):
+    """
+    Checks that two (spans, events, payload) results of simulate have the same events, and the same spans in any order
+    """
+    actual_spans, actual_sim_events, _ = actual
+    expected_spans, expected_sim_events, _ = expected
+    assert history_strings(actual_sim_events) == history_strings(expected_sim_events)
+    assert comparable_spans(actual_spans) == comparable_spans(expected_spans)
 
-    def register_engine_with_error_activity(engine):
-        register_engine(engine)
 
-        def spoofed_get_activity_types():
-            activity_types = dict(model_.Model().get_activity_types())
-            activity_types.update(overrides)
-            return activity_types
+def make_register_engine_with_overrides(overrides):
+    """
+    Returns a register_engine that also spoofs the activity types of each registered engine's model, with overrides
+    applied. Engines only read the activity types, so every engine registered through it shares one dict.
 
+    simulate builds each engine's activity dispatch (register_activity_types) right after calling register_engine, so
+    the spoofing must happen here: activity types changed any later are not seen by the engine.
+    """
+    activity_types = dict(model_.Model().get_activity_types())
+    activity_types.update(overrides)
+
+    def spoofed_get_activity_types():
+        return activity_types
+
+    def register_engine(engine):
+        facade.register_engine(engine)
         engine.model.get_activity_types = spoofed_get_activity_types
 
-    actual_spans, actual_sim_events, _ = incremental_sim.simulate_incremental(
-        register_engine_with_error_activity, model.Model, new_plan, old_plan, payload
-    )
+    return register_engine
+
+
+def simulate_reference(model_class, plan):
+    """
+    sim.simulate, memoized by model class and plan. Many test cases share plans, and the tests only read these results,
+    so each distinct plan is simulated by the reference engine once per session
+    """
+    return _simulate_reference(model_class, tuple(hashable_directive(x) for x in plan.directives))
 
-    actual = [(x, sim.EventGraph.to_string(y)) for x, y in actual_sim_events]
-    expected = [(x, sim.EventGraph.to_string(y)) for x, y in expected_sim_events]
-    print()
-    print("Expected :", expected)
-    print("Actual   :", actual)
 
-    assert actual == expected
-    actual_spans_processed = set((hashable_directive(rename(x)), y, z) for x, y, z in actual_spans)
-    expected_spans_processed = set((hashable_directive(rename(x)), y, z) for x, y, z in expected_spans)
-    assert actual_spans_processed == expected_spans_processed
+@functools.lru_cache(maxsize=None)
+def _simulate_reference(model_class, plan_key):
+    return sim.simulate(facade.register_engine, model_class, Plan(restore_directive(x) for x in plan_key))
+
+
+def comparable_spans(spans):
+    """
+    Spans as a set of hashable (directive, start, end), with anonymous directive types renamed, so that spans from
+    different engines can be compared regardless of order
+    """
+    return set((hashable_directive(rename(x)), y, z) for x, y, z in spans)
 
 
 def rename(directive: Directive):